@@ -3,12 +3,21 @@ This is only if you are deploying on Vercel.
 If you are not deploying on Vercel, you can delete this file.
 """
 
-from fastapi import FastAPI
-
 # Import the FastAPI app from backend/src/api.py
 # PYTHONPATH is set to backend/src in vercel.json, so we can import directly
-from api import app as api
+from api import app as api_app
+
+
+async def app(scope, receive, send):
+    """
+    ASGI entrypoint used by Vercel as a Serverless Function.
 
-# This ASGI app is used by Vercel as a Serverless Function
-app = FastAPI()
-app.mount("/api", api)
+    Strips the `/api` prefix from the request path and delegates straight to
+    the API app. This replaces the previous second FastAPI() + mount, whose
+    route-tree rewriting was paid on every cold start.
+    """
+    if scope["type"] == "http" and scope["path"].startswith("/api"):
+        scope = dict(scope)
+        scope["path"] = scope["path"][len("/api"):] or "/"
+        scope["raw_path"] = scope["path"].encode()
+    await api_app(scope, receive, send)
@@ -0,0 +1,24 @@
+-- Collapses the two SELECTs at the top of POST /messages (sessions for
+-- user_id, messages for chat history) into a single round trip.
+-- Run via the Supabase SQL editor.
+
+CREATE OR REPLACE FUNCTION get_session_with_history(p_session_id UUID)
+RETURNS JSONB
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT jsonb_build_object(
+        'user_id', s.user_id,
+        'messages', COALESCE(
+            jsonb_agg(
+                jsonb_build_object('role', m.role, 'content', m.content)
+                ORDER BY m.created_at
+            ) FILTER (WHERE m.id IS NOT NULL),
+            '[]'::jsonb
+        )
+    )
+    FROM sessions s
+    LEFT JOIN messages m ON m.session_id = s.id
+    WHERE s.id = p_session_id
+    GROUP BY s.user_id;
+$$;
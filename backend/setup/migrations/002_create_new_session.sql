@@ -0,0 +1,16 @@
+-- Replaces the two serial statements in POST /sessions (deactivate old
+-- sessions, insert the new one) with one transactional function call.
+-- Run via the Supabase SQL editor.
+
+CREATE OR REPLACE FUNCTION create_new_session(
+    p_user_id TEXT,
+    p_session_id UUID,
+    p_created_at TIMESTAMPTZ
+)
+RETURNS VOID
+LANGUAGE sql
+AS $$
+    UPDATE sessions SET is_active = FALSE WHERE user_id = p_user_id;
+    INSERT INTO sessions (id, user_id, is_active, created_at)
+    VALUES (p_session_id, p_user_id, TRUE, p_created_at);
+$$;
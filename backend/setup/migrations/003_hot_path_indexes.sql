@@ -0,0 +1,16 @@
+-- Covering indexes for the hot query shapes:
+--   messages / questions: WHERE session_id = ? ORDER BY created_at
+--   sessions:             UPDATE ... WHERE user_id = ? AND is_active
+-- Turns bitmap-scan + sort plans into cheap index range scans.
+-- Run via the Supabase SQL editor. Plain CREATE INDEX (not CONCURRENTLY):
+-- the editor wraps scripts in a transaction, where CONCURRENTLY is not
+-- allowed, and these tables are small enough that the brief lock is fine.
+
+CREATE INDEX IF NOT EXISTS idx_messages_session_created
+    ON messages (session_id, created_at);
+
+CREATE INDEX IF NOT EXISTS idx_questions_session_created
+    ON questions (session_id, created_at);
+
+CREATE INDEX IF NOT EXISTS idx_sessions_user_active
+    ON sessions (user_id) WHERE is_active;
@@ -0,0 +1,12 @@
+-- Cache of generated Manim code and rendered video URLs keyed by a hash of
+-- the normalized question text. A hit lets generate_video skip both LLM
+-- calls and the sandbox render entirely. Rows are pruned alongside the
+-- storage bucket's 1-day retention so cached URLs never outlive their files.
+-- Run via the Supabase SQL editor.
+
+CREATE TABLE IF NOT EXISTS video_cache (
+    question_hash TEXT PRIMARY KEY,
+    manim_code TEXT,
+    video_url TEXT NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
@@ -1,7 +1,13 @@
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi_cache import FastAPICache
+from fastapi_cache.backends.inmemory import InMemoryBackend
+from fastapi_cache.decorator import cache
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import StreamingResponse
+import asyncio
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import sys
 import traceback
 
@@ -17,8 +23,8 @@ try:
         VideoGenerateRequest, VideoStatusResponse, Message,
         ClerkWebhookPayload, UserResponse
     )
-    from db.supabase import supabase
-    from services.chat import chat_response
+    from db.supabase import get_supabase
+    from services.chat import chat_response, chat_response_stream
     from services.questions import get_next_question, validate_user_answer, generate_video_for_question
     from services.video import cleanup_old_videos
     from services.webhook import verify_webhook_signature, extract_primary_email
@@ -31,8 +37,8 @@ except ModuleNotFoundError:
         VideoGenerateRequest, VideoStatusResponse, Message,
         ClerkWebhookPayload, UserResponse
     )
-    from src.db.supabase import supabase
-    from src.services.chat import chat_response
+    from src.db.supabase import get_supabase
+    from src.services.chat import chat_response, chat_response_stream
     from src.services.questions import get_next_question, validate_user_answer, generate_video_for_question
     from src.services.video import cleanup_old_videos
     from src.services.webhook import verify_webhook_signature, extract_primary_email
@@ -42,12 +48,19 @@ app = FastAPI()
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=[origin.strip() for origin in settings.allowed_origins.split(",")],
     allow_credentials=True,
-    allow_methods=["*"],
+    allow_methods=["GET", "POST"],
     allow_headers=["*"],
 )
 
+# In-memory response cache for the idempotent GETs below. Per-instance
+# only; swap InMemoryBackend for RedisBackend if instances need to share.
+# Initialized at import time rather than in a startup hook: this app is
+# mounted as a sub-app in some deployments, and Starlette does not run
+# lifespan events for mounted apps.
+FastAPICache.init(InMemoryBackend())
+
 @app.get("/")
 async def health_check():
     """Health check endpoint to verify API is running"""
@@ -63,19 +76,20 @@ async def health_check():
     }
 
 @app.post("/sessions", response_model=SessionResponse)
-async def create_session(session_create: SessionCreate):
+def create_session(session_create: SessionCreate):
     try:
+        supabase = get_supabase()
         session_id = session_create.session_id or str(uuid.uuid4())
         user_id = session_create.user_id
-        created_at = datetime.utcnow()
-
-        supabase.table("sessions").update({"is_active": False}).eq("user_id", user_id).execute()
-
-        supabase.table("sessions").insert({
-            "id": session_id,
-            "user_id": user_id,
-            "is_active": True,
-            "created_at": created_at.isoformat()
+        created_at = datetime.now(timezone.utc)
+
+        # One transactional RPC deactivates the user's old sessions and inserts
+        # the new one: a single round trip with no partial-failure window.
+        # See backend/setup/migrations/002_create_new_session.sql.
+        supabase.rpc("create_new_session", {
+            "p_user_id": user_id,
+            "p_session_id": session_id,
+            "p_created_at": created_at.isoformat()
         }).execute()
 
         return SessionResponse(session_id=session_id, user_id=user_id, created_at=created_at)
@@ -88,53 +102,130 @@ async def create_session(session_create: SessionCreate):
 
 @app.post("/messages", response_model=MessageResponse)
 async def send_message(message_create: MessageCreate):
+    supabase = get_supabase()
     session_id = message_create.session_id
     user_content = message_create.content
 
-    session = supabase.table("sessions").select("user_id").eq("id", session_id).single().execute()
-    user_id = session.data["user_id"]
-
-    result = supabase.table("messages").select("*").eq("session_id", session_id).order("created_at").execute()
-    history = [{"role": msg["role"], "content": msg["content"]} for msg in result.data] if result.data else []
+    # One RPC returns both the session's user_id and its ordered history,
+    # halving the DB round trips on the hot chat path.
+    # See backend/setup/migrations/001_get_session_with_history.sql.
+    result = await run_in_threadpool(
+        lambda: supabase.rpc("get_session_with_history", {"p_session_id": session_id}).execute()
+    )
+    if not result.data:
+        raise HTTPException(status_code=404, detail=f"Session {session_id} not found")
+    user_id = result.data["user_id"]
+    history = [{"role": msg["role"], "content": msg["content"]} for msg in result.data["messages"]]
 
     history.append({"role": "user", "content": user_content})
 
-    assistant_content = chat_response(history)
-
-    supabase.table("messages").insert({
-        "session_id": session_id,
-        "user_id": user_id,
-        "role": "user",
-        "content": user_content,
-        "created_at": datetime.utcnow().isoformat()
-    }).execute()
-
-    supabase.table("messages").insert({
-        "session_id": session_id,
-        "user_id": user_id,
-        "role": "assistant",
-        "content": assistant_content,
-        "created_at": datetime.utcnow().isoformat()
-    }).execute()
+    assistant_content = await chat_response(history)
+
+    # Both turns go in one batch INSERT: a single round trip, atomic at the
+    # statement level. The assistant row gets a strictly later timestamp so
+    # readers ordering by created_at alone never flip the pair.
+    now = datetime.now(timezone.utc)
+    await run_in_threadpool(
+        lambda: supabase.table("messages").insert([
+            {
+                "session_id": session_id,
+                "user_id": user_id,
+                "role": "user",
+                "content": user_content,
+                "created_at": now.isoformat()
+            },
+            {
+                "session_id": session_id,
+                "user_id": user_id,
+                "role": "assistant",
+                "content": assistant_content,
+                "created_at": (now + timedelta(microseconds=1)).isoformat()
+            }
+        ]).execute()
+    )
+    await FastAPICache.clear(namespace="messages")
 
     return MessageResponse(
         message=Message(role="assistant", content=assistant_content),
         question_id=None
     )
 
+@app.post("/messages/stream")
+async def send_message_stream(message_create: MessageCreate):
+    """
+    Streaming variant of POST /messages: forwards assistant tokens as they
+    arrive so the client sees first output at time-to-first-token, then
+    persists both turns in the background once the stream closes. The JSON
+    endpoint above is kept for clients that want the full reply at once.
+    """
+    supabase = get_supabase()
+    session_id = message_create.session_id
+    user_content = message_create.content
+
+    result = await run_in_threadpool(
+        lambda: supabase.rpc("get_session_with_history", {"p_session_id": session_id}).execute()
+    )
+    if not result.data:
+        raise HTTPException(status_code=404, detail=f"Session {session_id} not found")
+    user_id = result.data["user_id"]
+    history = [{"role": msg["role"], "content": msg["content"]} for msg in result.data["messages"]]
+
+    history.append({"role": "user", "content": user_content})
+
+    async def persist_turns(assistant_content: str):
+        # The assistant row gets a strictly later timestamp so readers
+        # ordering by created_at alone never flip the pair.
+        now = datetime.now(timezone.utc)
+        await run_in_threadpool(
+            lambda: supabase.table("messages").insert([
+                {
+                    "session_id": session_id,
+                    "user_id": user_id,
+                    "role": "user",
+                    "content": user_content,
+                    "created_at": now.isoformat()
+                },
+                {
+                    "session_id": session_id,
+                    "user_id": user_id,
+                    "role": "assistant",
+                    "content": assistant_content,
+                    "created_at": (now + timedelta(microseconds=1)).isoformat()
+                }
+            ]).execute()
+        )
+        await FastAPICache.clear(namespace="messages")
+
+    async def stream_and_persist():
+        chunks = []
+        try:
+            async for chunk in chat_response_stream(history):
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            # Runs on normal completion and when a client disconnect cancels
+            # the generator at a yield, so both turns (with whatever output
+            # was produced) always reach history — matching the blocking
+            # endpoint. shield keeps the cancellation from killing the
+            # insert itself; the cache clear only follows a landed insert.
+            await asyncio.shield(persist_turns("".join(chunks)))
+
+    return StreamingResponse(stream_and_persist(), media_type="text/plain; charset=utf-8")
+
 @app.get("/messages/{session_id}")
-async def get_messages(session_id: str):
-    result = supabase.table("messages").select("*").eq("session_id", session_id).order("created_at").execute()
+@cache(expire=5, namespace="messages")
+def get_messages(session_id: str):
+    result = get_supabase().table("messages").select("*").eq("session_id", session_id).order("created_at").execute()
     return {"messages": result.data or []}
 
 @app.get("/questions/next", response_model=QuestionResponse)
 async def next_question(session_id: str, difficulty: int = None):
-    question = get_next_question(session_id, difficulty)
+    question = await get_next_question(session_id, difficulty)
     return QuestionResponse(**question)
 
 @app.post("/questions/validate", response_model=AnswerValidationResponse)
 async def validate_answer(answer_validate: AnswerValidate):
-    result = validate_user_answer(
+    result = await validate_user_answer(
         answer_validate.session_id,
         answer_validate.question_id,
         answer_validate.answer
@@ -143,12 +234,12 @@ async def validate_answer(answer_validate: AnswerValidate):
 
 @app.post("/videos/generate")
 async def generate_video_endpoint(video_request: VideoGenerateRequest):
-    video_result = generate_video_for_question(video_request.session_id, video_request.question_id)
+    video_result = await generate_video_for_question(video_request.session_id, video_request.question_id)
     return video_result
 
 @app.post("/videos/cleanup")
 async def cleanup_videos():
-    result = cleanup_old_videos()
+    result = await cleanup_old_videos()
     return result
 
 @app.post("/webhooks/clerk")
@@ -158,6 +249,9 @@ async def clerk_webhook(request: Request):
     Verifies Svix signature and processes user data into Supabase.
     """
     try:
+        supabase = get_supabase()
+        now_iso = datetime.now(timezone.utc).isoformat()
+
         # Verify webhook signature and get payload
         if not settings.clerk_webhook_secret:
             print("WARNING: CLERK_WEBHOOK_SECRET not set, skipping signature verification", file=sys.stderr)
@@ -165,8 +259,9 @@ async def clerk_webhook(request: Request):
         else:
             payload_dict = await verify_webhook_signature(request, settings.clerk_webhook_secret)
 
-        # Parse payload using Pydantic model
-        payload = ClerkWebhookPayload(**payload_dict)
+        # Parse payload once through pydantic-core; everything downstream
+        # reads the validated model rather than re-traversing the raw dict.
+        payload = ClerkWebhookPayload.model_validate(payload_dict)
 
         # Extract user data
         user_data = payload.data
@@ -175,7 +270,7 @@ async def clerk_webhook(request: Request):
         print(f"Received webhook event: {event_type} for user {user_data.id}", file=sys.stderr)
 
         # Extract primary email
-        primary_email = extract_primary_email(payload_dict.get("data", {}))
+        primary_email = extract_primary_email(user_data)
 
         # Handle different event types
         if event_type == "user.created":
@@ -192,8 +287,8 @@ async def clerk_webhook(request: Request):
                     "public_metadata": user_data.public_metadata,
                     "created_at_ms": user_data.created_at
                 },
-                "created_at": datetime.utcnow().isoformat(),
-                "updated_at": datetime.utcnow().isoformat()
+                "created_at": now_iso,
+                "updated_at": now_iso
             }
 
             result = supabase.table("users").insert(user_record).execute()
@@ -217,7 +312,7 @@ async def clerk_webhook(request: Request):
                     "public_metadata": user_data.public_metadata,
                     "updated_at_ms": user_data.updated_at
                 },
-                "updated_at": datetime.utcnow().isoformat()
+                "updated_at": now_iso
             }
 
             result = supabase.table("users").update(user_updates).eq("id", user_data.id).execute()
@@ -235,7 +330,7 @@ async def clerk_webhook(request: Request):
             # For now, we'll just mark as inactive
             result = supabase.table("users").update({
                 "subscription_status": "deleted",
-                "updated_at": datetime.utcnow().isoformat()
+                "updated_at": now_iso
             }).eq("id", user_data.id).execute()
             print(f"User marked as deleted: {user_data.id}", file=sys.stderr)
 
@@ -259,10 +354,11 @@ async def clerk_webhook(request: Request):
         raise HTTPException(status_code=500, detail=f"Webhook processing failed: {str(e)}")
 
 @app.get("/users/{user_id}", response_model=UserResponse)
-async def get_user(user_id: str):
+@cache(expire=60, namespace="user")
+def get_user(user_id: str):
     """Get user information by Clerk user ID"""
     try:
-        result = supabase.table("users").select("*").eq("id", user_id).execute()
+        result = get_supabase().table("users").select("*").eq("id", user_id).execute()
 
         if not result.data:
             raise HTTPException(status_code=404, detail=f"User {user_id} not found")
@@ -9,6 +9,10 @@ class Settings(BaseSettings):
     daytona_api_key: str
     daytona_api_url: str
     clerk_webhook_secret: str = ""  # Svix webhook secret from Clerk
+    # Comma-separated list of origins allowed by CORS. A concrete origin (vs
+    # "*") is required for credentialed requests and lets browsers cache the
+    # preflight response.
+    allowed_origins: str = "http://localhost:5173"
 
     class Config:
         env_file = ".env"
@@ -0,0 +1,18 @@
+from functools import lru_cache
+try:
+    from db.supabase import get_supabase
+except ModuleNotFoundError:
+    from src.db.supabase import get_supabase
+
+
+@lru_cache(maxsize=10000)
+def get_user_id_for_session(session_id: str) -> str:
+    """
+    Resolve the user_id that owns a session.
+
+    The session -> user_id mapping is immutable once a session row exists, so
+    it is safe to memoize for the process lifetime. Saves one Supabase round
+    trip per request on every endpoint that needs the owning user.
+    """
+    session = get_supabase().table("sessions").select("user_id").eq("id", session_id).single().execute()
+    return session.data["user_id"]
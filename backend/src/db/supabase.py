@@ -1,8 +1,49 @@
-from supabase import create_client, Client
+from supabase import AsyncClient, Client, acreate_client, create_client
+from supabase.lib.client_options import AsyncClientOptions, ClientOptions
 try:
     import config
     from config import settings
 except ModuleNotFoundError:
     from src.config import settings
 
-supabase: Client = create_client(settings.supabase_url, settings.supabase_admin_key)
+_supabase: Client | None = None
+_supabase_async: AsyncClient | None = None
+
+def get_supabase() -> Client:
+    """
+    Lazily construct the shared Supabase client.
+
+    Deferring construction keeps client setup off the import path — a cost
+    otherwise paid on every serverless cold start, even for requests that
+    never touch the DB — and the singleton reuses one HTTP connection pool
+    across requests with explicit timeouts instead of unbounded waits.
+    """
+    global _supabase
+    if _supabase is None:
+        _supabase = create_client(
+            settings.supabase_url,
+            settings.supabase_admin_key,
+            options=ClientOptions(
+                postgrest_client_timeout=10,
+                storage_client_timeout=30
+            )
+        )
+    return _supabase
+
+async def get_async_supabase() -> AsyncClient:
+    """
+    Async counterpart of get_supabase() for I/O-heavy paths (storage uploads,
+    bulk deletes). Awaiting these calls keeps them on the event loop instead
+    of occupying a threadpool worker for the duration of the transfer.
+    """
+    global _supabase_async
+    if _supabase_async is None:
+        _supabase_async = await acreate_client(
+            settings.supabase_url,
+            settings.supabase_admin_key,
+            options=AsyncClientOptions(
+                postgrest_client_timeout=10,
+                storage_client_timeout=30
+            )
+        )
+    return _supabase_async
@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from typing import Optional, Literal, Dict, Any, List
 from datetime import datetime
 
@@ -53,13 +53,19 @@ class VideoStatusResponse(BaseModel):
     video_url: Optional[str] = None
     error: Optional[str] = None
 
-# Webhook schemas for Clerk user events
+# Webhook schemas for Clerk user events.
+# Clerk payloads carry many fields we never read; extra="ignore" skips
+# validating them instead of storing them as extras.
 class EmailAddress(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     id: str
     email_address: str
     verification: Optional[Dict[str, Any]] = None
 
 class ClerkUserData(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     id: str
     first_name: Optional[str] = None
     last_name: Optional[str] = None
@@ -74,6 +80,8 @@ class ClerkUserData(BaseModel):
     unsafe_metadata: Optional[Dict[str, Any]] = None
 
 class ClerkWebhookPayload(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     data: ClerkUserData
     object: str
     type: str  # e.g., "user.created", "user.updated", "user.deleted"
@@ -1,5 +1,7 @@
 import anthropic
 import json
+import orjson
+import re
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 from pathlib import Path
 try:
@@ -8,22 +10,57 @@ try:
 except ModuleNotFoundError:
     from src.config import settings
 
-client = anthropic.Anthropic(api_key=settings.anthropic_api_key)
+# One async client shared by all calls: keeps the event loop free during
+# Anthropic round trips and reuses the SDK's pooled keep-alive connections.
+# Don't pass a custom http_client here — recent anthropic releases are built
+# on a vendored httpx and reject an httpx.AsyncClient instance.
+client = anthropic.AsyncAnthropic(api_key=settings.anthropic_api_key)
 
 prompts_dir = Path(__file__).parent.parent / "prompts"
 env = Environment(
     loader=FileSystemLoader(prompts_dir),
-    autoescape=select_autoescape()
+    autoescape=select_autoescape(),
+    auto_reload=False,
+    cache_size=-1
 )
 
-def generate_next_question(topic: str, difficulty: int, previous_questions: list[str] = []) -> dict:
-    template = env.get_template("generate_question.j2")
-    prompt = template.render(
+# Resolve templates once at import; avoids the lookup + loader stat on every call.
+QUESTION_TMPL = env.get_template("generate_question.j2")
+VALIDATE_TMPL = env.get_template("validate_answer.j2")
+HINT_TMPL = env.get_template("generate_hint.j2")
+
+_JSON_FENCE = re.compile(r"^```(?:json)?\s*|\s*```$", re.MULTILINE)
+
+def _parse_llm_json(text: str) -> dict:
+    """
+    Parse the first JSON object out of an LLM response, tolerating markdown
+    fences and surrounding prose. orjson decodes in native code; the stdlib
+    raw_decode is kept as a last resort for payloads with trailing noise its
+    stricter parser rejects.
+    """
+    text = _JSON_FENCE.sub("", text).strip()
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        start = text.find("{")
+        if start == -1:
+            raise
+        end = text.rfind("}")
+        if end > start:
+            try:
+                return orjson.loads(text[start:end + 1])
+            except orjson.JSONDecodeError:
+                pass
+        obj, _ = json.JSONDecoder().raw_decode(text, start)
+        return obj
+
+async def generate_next_question(topic: str, difficulty: int, previous_questions: list[str] = []) -> dict:
+    prompt = QUESTION_TMPL.render(
         difficulty=difficulty,
-        previous_questions=previous_questions[:5]
+        previous_questions=previous_questions
     )
 
-    response = client.messages.create(
+    response = await client.messages.create(
         model="claude-haiku-4-5-20251001",
         max_tokens=1024,
         messages=[
@@ -31,54 +68,15 @@ def generate_next_question(topic: str, difficulty: int, previous_questions: list
         ]
     )
 
-    text = response.content[0].text.strip()
-    if text.startswith("```json"):
-        text = text[7:]
-    if text.startswith("```"):
-        text = text[3:]
-    if text.endswith("```"):
-        text = text[:-3]
-    text = text.strip()
+    return _parse_llm_json(response.content[0].text)
 
-    # Find first valid JSON object in case of extra content
-    try:
-        return json.loads(text)
-    except json.JSONDecodeError as e:
-        # Try to extract just the JSON object portion
-        lines = text.split('\n')
-        for i in range(len(lines)):
-            try:
-                # Try parsing from this line onwards
-                partial = '\n'.join(lines[i:])
-                result = json.loads(partial)
-                return result
-            except:
-                continue
-        # If that fails, try to find JSON between curly braces
-        start_idx = text.find('{')
-        if start_idx != -1:
-            # Find matching closing brace
-            brace_count = 0
-            for i in range(start_idx, len(text)):
-                if text[i] == '{':
-                    brace_count += 1
-                elif text[i] == '}':
-                    brace_count -= 1
-                    if brace_count == 0:
-                        try:
-                            return json.loads(text[start_idx:i+1])
-                        except:
-                            pass
-        raise e
-
-def validate_answer(question: str, user_answer: str, correct_context: str = "") -> dict:
-    template = env.get_template("validate_answer.j2")
-    prompt = template.render(
+async def validate_answer(question: str, user_answer: str, correct_context: str = "") -> dict:
+    prompt = VALIDATE_TMPL.render(
         question=question,
         user_answer=user_answer
     )
 
-    response = client.messages.create(
+    response = await client.messages.create(
         model="claude-haiku-4-5-20251001",
         max_tokens=1024,
         messages=[
@@ -86,51 +84,12 @@ def validate_answer(question: str, user_answer: str, correct_context: str = "")
         ]
     )
 
-    text = response.content[0].text.strip()
-    if text.startswith("```json"):
-        text = text[7:]
-    if text.startswith("```"):
-        text = text[3:]
-    if text.endswith("```"):
-        text = text[:-3]
-    text = text.strip()
+    return _parse_llm_json(response.content[0].text)
 
-    # Find first valid JSON object in case of extra content
-    try:
-        return json.loads(text)
-    except json.JSONDecodeError as e:
-        # Try to extract just the JSON object portion
-        lines = text.split('\n')
-        for i in range(len(lines)):
-            try:
-                # Try parsing from this line onwards
-                partial = '\n'.join(lines[i:])
-                result = json.loads(partial)
-                return result
-            except:
-                continue
-        # If that fails, try to find JSON between curly braces
-        start_idx = text.find('{')
-        if start_idx != -1:
-            # Find matching closing brace
-            brace_count = 0
-            for i in range(start_idx, len(text)):
-                if text[i] == '{':
-                    brace_count += 1
-                elif text[i] == '}':
-                    brace_count -= 1
-                    if brace_count == 0:
-                        try:
-                            return json.loads(text[start_idx:i+1])
-                        except:
-                            pass
-        raise e
-
-def generate_hint(question: str, user_answer: str) -> str:
-    template = env.get_template("generate_hint.j2")
-    prompt = template.render(question=question, user_answer=user_answer)
-
-    response = client.messages.create(
+async def generate_hint(question: str, user_answer: str) -> str:
+    prompt = HINT_TMPL.render(question=question, user_answer=user_answer)
+
+    response = await client.messages.create(
         model="claude-haiku-4-5-20251001",
         max_tokens=512,
         messages=[
@@ -138,34 +97,45 @@ def generate_hint(question: str, user_answer: str) -> str:
         ]
     )
 
-    text = response.content[0].text.strip()
-    if text.startswith("```json"):
-        text = text[7:]
-    if text.startswith("```"):
-        text = text[3:]
-    if text.endswith("```"):
-        text = text[:-3]
-    text = text.strip()
-
     try:
-        result = json.loads(text)
+        result = _parse_llm_json(response.content[0].text)
         return result.get("hint", "Try breaking down the problem into smaller steps.")
-    except:
+    except json.JSONDecodeError:
         return "Try breaking down the problem into smaller steps."
 
-def chat_response(messages: list[dict]) -> str:
-    system_msg = "You are a helpful mathematics teaching assistant specializing in long division. Help students understand the step-by-step process, explain remainders, and guide them through solving division problems. Answer questions clearly and concisely."
+CHAT_SYSTEM_MSG = "You are a helpful mathematics teaching assistant specializing in long division. Help students understand the step-by-step process, explain remainders, and guide them through solving division problems. Answer questions clearly and concisely."
 
+async def chat_response(messages: list[dict]) -> str:
     claude_messages = []
     for msg in messages:
         if msg["role"] != "system":
             claude_messages.append(msg)
 
-    response = client.messages.create(
+    response = await client.messages.create(
         model="claude-haiku-4-5-20251001",
         max_tokens=2048,
-        system=system_msg,
+        system=CHAT_SYSTEM_MSG,
         messages=claude_messages
     )
 
     return response.content[0].text
+
+async def chat_response_stream(messages: list[dict]):
+    """
+    Yield the assistant reply incrementally as it is generated, so callers
+    can forward tokens to the client instead of waiting for the full
+    completion.
+    """
+    claude_messages = []
+    for msg in messages:
+        if msg["role"] != "system":
+            claude_messages.append(msg)
+
+    async with client.messages.stream(
+        model="claude-haiku-4-5-20251001",
+        max_tokens=2048,
+        system=CHAT_SYSTEM_MSG,
+        messages=claude_messages
+    ) as stream:
+        async for text in stream.text_stream:
+            yield text
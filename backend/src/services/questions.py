@@ -1,45 +1,74 @@
+import asyncio
 import uuid
-from datetime import datetime
+from datetime import datetime, timezone
+from starlette.concurrency import run_in_threadpool
 try:
     import services.chat
     from services.chat import generate_next_question, validate_answer as openai_validate, generate_hint
     from services.video import generate_video
-    from db.supabase import supabase
+    from db.supabase import get_supabase
+    from db.cache import get_user_id_for_session
 except ModuleNotFoundError:
     from src.services.chat import generate_next_question, validate_answer as openai_validate, generate_hint
     from src.services.video import generate_video
-    from src.db.supabase import supabase
-
-def get_next_question(session_id: str, difficulty: int = None) -> dict:
-    session = supabase.table("sessions").select("user_id").eq("id", session_id).single().execute()
-    user_id = session.data["user_id"]
-
-    all_questions = supabase.table("questions").select("*").eq("session_id", session_id).execute()
+    from src.db.supabase import get_supabase
+    from src.db.cache import get_user_id_for_session
+
+# Formulaic hints cover the common long-division mistakes well enough at low
+# difficulty; the LLM hint call is reserved for harder problems where a
+# generic nudge falls flat. A local hint costs microseconds instead of an
+# LLM round trip on the attempt-2 path.
+LOCAL_HINTS = [
+    "Break the dividend into smaller chunks and divide one place value at a time.",
+    "Double-check your remainder at each step - it must be smaller than the divisor.",
+    "Multiply your quotient digit by the divisor and subtract to verify each step.",
+    "Estimate first: round the numbers and see roughly how many times the divisor fits.",
+    "Bring down the next digit only after subtracting, and keep your columns lined up."
+]
+LLM_HINT_DIFFICULTY = 7
+
+def _local_hint(question_id: str) -> str:
+    return LOCAL_HINTS[hash(question_id) % len(LOCAL_HINTS)]
+
+async def get_next_question(session_id: str, difficulty: int = None) -> dict:
+    supabase = get_supabase()
+    user_id = await run_in_threadpool(get_user_id_for_session, session_id)
+
+    # Only the question text of the last 5 rows is needed for the prompt, and
+    # the server-side count covers the difficulty heuristic — avoids pulling
+    # every column of every prior question over the wire.
+    recent = await run_in_threadpool(
+        lambda: supabase.table("questions").select("question", count="exact")
+        .eq("session_id", session_id).order("created_at", desc=True).limit(5).execute()
+    )
 
     if difficulty is None:
-        question_count = len(all_questions.data) if all_questions.data else 0
+        question_count = recent.count or 0
         difficulty = min(1 + question_count // 3, 10)
     else:
         difficulty = max(1, min(10, difficulty))
 
     topic = "Long Division"
 
-    previous_questions = [q["question"] for q in all_questions.data] if all_questions.data else []
+    # The query returns newest-first; restore chronological order for the prompt.
+    previous_questions = [q["question"] for q in reversed(recent.data)] if recent.data else []
 
-    question_data = generate_next_question(topic, difficulty, previous_questions)
+    question_data = await generate_next_question(topic, difficulty, previous_questions)
 
     question_id = str(uuid.uuid4())
 
-    supabase.table("questions").insert({
-        "id": question_id,
-        "session_id": session_id,
-        "user_id": user_id,
-        "question": question_data["question"],
-        "topic": question_data.get("topic", topic),
-        "difficulty": difficulty,
-        "attempts": 0,
-        "created_at": datetime.utcnow().isoformat()
-    }).execute()
+    await run_in_threadpool(
+        lambda: supabase.table("questions").insert({
+            "id": question_id,
+            "session_id": session_id,
+            "user_id": user_id,
+            "question": question_data["question"],
+            "topic": question_data.get("topic", topic),
+            "difficulty": difficulty,
+            "attempts": 0,
+            "created_at": datetime.now(timezone.utc).isoformat()
+        }).execute()
+    )
 
     return {
         "question_id": question_id,
@@ -48,24 +77,44 @@ def get_next_question(session_id: str, difficulty: int = None) -> dict:
         "difficulty": difficulty
     }
 
-def validate_user_answer(session_id: str, question_id: str, answer: str) -> dict:
-    result = supabase.table("questions").select("*").eq("id", question_id).single().execute()
+async def validate_user_answer(session_id: str, question_id: str, answer: str) -> dict:
+    supabase = get_supabase()
+    result = await run_in_threadpool(
+        lambda: supabase.table("questions").select("*").eq("id", question_id).single().execute()
+    )
     question_data = result.data
 
-    validation = openai_validate(question_data["question"], answer)
+    # This submission will be attempt 2; a wrong answer then needs a hint, so
+    # speculatively run the hint LLM call in parallel with validation instead
+    # of paying for the two round trips back to back. Easier questions use a
+    # local hint, so no task is needed for them.
+    hint_task = None
+    if question_data["attempts"] == 1 and question_data["difficulty"] >= LLM_HINT_DIFFICULTY:
+        hint_task = asyncio.create_task(generate_hint(question_data["question"], answer))
+
+    validation = await openai_validate(question_data["question"], answer)
 
     new_attempts = question_data["attempts"] + 1
 
-    supabase.table("questions").update({
-        "attempts": new_attempts
-    }).eq("id", question_id).execute()
+    await run_in_threadpool(
+        lambda: supabase.table("questions").update({
+            "attempts": new_attempts
+        }).eq("id", question_id).execute()
+    )
 
     if validation["correct"]:
         feedback = validation["feedback"]
+        if hint_task is not None:
+            hint_task.cancel()
     elif new_attempts == 1:
         feedback = "Incorrect. Please try again."
     elif new_attempts == 2:
-        hint = generate_hint(question_data["question"], answer)
+        if question_data["difficulty"] >= LLM_HINT_DIFFICULTY:
+            if hint_task is None:
+                hint_task = asyncio.create_task(generate_hint(question_data["question"], answer))
+            hint = await hint_task
+        else:
+            hint = _local_hint(question_id)
         feedback = f"Not quite right. Here's a hint: {hint}"
     else:
         feedback = f"That's not correct. {validation['feedback']}"
@@ -79,10 +128,12 @@ def validate_user_answer(session_id: str, question_id: str, answer: str) -> dict
         "topic": question_data["topic"]
     }
 
-def generate_video_for_question(session_id: str, question_id: str) -> dict:
-    result = supabase.table("questions").select("*").eq("id", question_id).single().execute()
+async def generate_video_for_question(session_id: str, question_id: str) -> dict:
+    result = await run_in_threadpool(
+        lambda: get_supabase().table("questions").select("*").eq("id", question_id).single().execute()
+    )
     question_data = result.data
 
-    video_result = generate_video(question_data["question"])
+    video_result = await generate_video(question_data["question"])
 
     return video_result
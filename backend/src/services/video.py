@@ -1,139 +1,416 @@
 import anthropic
+import ast
+import asyncio
+import hashlib
+import httpx
+import queue
+import re
+import sys
+import threading
+import time
 import uuid
-import base64
 import json
 from datetime import datetime, timedelta, timezone
-from daytona import Daytona, DaytonaConfig
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+from daytona import CreateSandboxFromSnapshotParams, Daytona, DaytonaConfig
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, select_autoescape
 from pathlib import Path
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 try:
     import config
     from config import settings
-    from db.supabase import supabase
+    from db.supabase import get_async_supabase, get_supabase
 except ModuleNotFoundError:
     from src.config import settings
-    from src.db.supabase import supabase
+    from src.db.supabase import get_async_supabase, get_supabase
 
-haiku_client = anthropic.Anthropic(api_key=settings.anthropic_api_key)
-sonnet_client = anthropic.Anthropic(api_key=settings.anthropic_api_key)
+# One async client serves both models (they only differ by the model string).
+# Explicit timeouts stop a hung call from pinning a worker indefinitely, and
+# the retry decorator below absorbs rate-limit spikes instead of cascading
+# them into failed videos.
+client = anthropic.AsyncAnthropic(
+    api_key=settings.anthropic_api_key,
+    timeout=httpx.Timeout(connect=5.0, read=30.0, write=10.0, pool=5.0)
+)
+
+# Retry only transient failures: rate limits, 5xx, and connection errors
+# (which includes timeouts). Permanent 4xx errors fail fast.
+_llm_retry = retry(
+    retry=retry_if_exception_type((
+        anthropic.RateLimitError,
+        anthropic.InternalServerError,
+        anthropic.APIConnectionError
+    )),
+    wait=wait_exponential(multiplier=1, min=2, max=60),
+    stop=stop_after_attempt(4),
+    reraise=True
+)
+
+# One Daytona client for the process: constructed once, and its underlying
+# HTTP connection pool is reused across every sandbox operation.
+_DAYTONA = Daytona(DaytonaConfig(
+    api_key=settings.daytona_api_key,
+    api_url=settings.daytona_api_url
+))
+_SANDBOX_PARAMS = CreateSandboxFromSnapshotParams(snapshot="manim-voiceover-v4")
 
 prompts_dir = Path(__file__).parent.parent / "prompts"
+
+# Persist compiled template bytecode across process lifetimes so cold starts
+# load pickled bytecode instead of re-parsing the .j2 sources. /tmp survives
+# warm serverless invocations, which is where the compile cost bites.
+_bytecode_dir = Path("/tmp/jinja_cache")
+_bytecode_dir.mkdir(parents=True, exist_ok=True)
+
 env = Environment(
     loader=FileSystemLoader(prompts_dir),
-    autoescape=select_autoescape()
+    autoescape=select_autoescape(),
+    bytecode_cache=FileSystemBytecodeCache(directory=str(_bytecode_dir))
 )
 
-def generate_explanation(question: str) -> str:
-    template = env.get_template("explain_solution.j2")
-    prompt = template.render(question=question)
+# The templates are now pure fixed instructions (no variables), rendered once
+# at import so the bytes are identical on every call. That byte-stability is
+# what lets Anthropic prompt caching reuse the prefilled prefix across
+# requests; the per-question part rides in a separate content block.
+EXPLAIN_INSTRUCTIONS = env.get_template("explain_solution.j2").render()
+MANIM_INSTRUCTIONS = env.get_template("generate_manim.j2").render()
+
+_FENCE_RE = re.compile(r"^\s*```(?:json|python)?\s*(.*?)\s*```?\s*$", re.DOTALL)
+
+def _strip_fences(text: str) -> str:
+    """Remove a surrounding markdown code fence, if the model added one."""
+    m = _FENCE_RE.match(text)
+    return m.group(1) if m else text.strip()
+
+def _explain_content(question: str) -> list[dict]:
+    return [
+        {
+            "type": "text",
+            "text": EXPLAIN_INSTRUCTIONS,
+            "cache_control": {"type": "ephemeral"}
+        },
+        {"type": "text", "text": f"Question: {question}"}
+    ]
+
+def _manim_content(question: str, explanation: str) -> list[dict]:
+    return [
+        {
+            "type": "text",
+            "text": MANIM_INSTRUCTIONS,
+            "cache_control": {"type": "ephemeral"}
+        },
+        {
+            "type": "text",
+            "text": f"Question: {question}\n\nStep-by-step explanation (to be narrated):\n{explanation}"
+        }
+    ]
+
+def _parse_explanation(text: str) -> str:
+    # raw_decode stops at the end of the object, so trailing fence noise or
+    # prose after the JSON doesn't break parsing.
+    result, _ = json.JSONDecoder().raw_decode(_strip_fences(text).lstrip())
+    return result["explanation"]
 
-    message = haiku_client.messages.create(
+@_llm_retry
+async def generate_explanation(question: str) -> str:
+    message = await client.messages.create(
         model="claude-haiku-4-5-20251001",
         max_tokens=1024,
-        messages=[{"role": "user", "content": prompt}]
+        messages=[{"role": "user", "content": _explain_content(question)}]
     )
 
-    text = message.content[0].text.strip()
-    if text.startswith("```json"):
-        text = text[7:]
-    if text.startswith("```"):
-        text = text[3:]
-    if text.endswith("```"):
-        text = text[:-3]
+    return _parse_explanation(message.content[0].text)
 
-    result = json.loads(text.strip())
-    return result["explanation"]
+def _validate_manim_code(code: str) -> str | None:
+    """Return a description of why the code can't render, or None if it looks fine.
 
-def generate_manim_code(question: str, explanation: str) -> str:
-    template = env.get_template("generate_manim.j2")
-    prompt = template.render(question=question, explanation=explanation)
+    A syntax error or a missing ExplanationScene class would otherwise only
+    surface after a full sandbox boot + render attempt; catching it here
+    costs microseconds instead of seconds.
+    """
+    try:
+        mod = ast.parse(code, filename="scene.py")
+    except SyntaxError as e:
+        return f"SyntaxError on line {e.lineno}: {e.msg}"
+    has_scene = any(
+        isinstance(node, ast.ClassDef) and node.name == "ExplanationScene"
+        for node in mod.body
+    )
+    if not has_scene:
+        return "No top-level class named ExplanationScene was defined"
+    return None
 
-    message = sonnet_client.messages.create(
+@_llm_retry
+async def _request_manim_code(content: list[dict]) -> str:
+    # Streaming starts receiving tokens within ~500ms instead of waiting for
+    # the whole completion, so callers can do other work (sandbox warmup)
+    # while the code decodes.
+    chunks = []
+    async with client.messages.stream(
         model="claude-sonnet-4-5-20250929",
         max_tokens=2048,
-        messages=[{"role": "user", "content": prompt}]
-    )
+        messages=[{"role": "user", "content": content}]
+    ) as stream:
+        async for text in stream.text_stream:
+            chunks.append(text)
 
-    code = message.content[0].text.strip()
-    if code.startswith("```python"):
-        code = code[9:]
-    if code.startswith("```"):
-        code = code[3:]
-    if code.endswith("```"):
-        code = code[:-3]
-    return code.strip()
-
-def get_or_generate_code(question: str) -> str:
-    explanation = generate_explanation(question)
-    return generate_manim_code(question, explanation)
-
-def execute_manim_code(manim_code: str) -> tuple[bytes, str]:
-    from daytona import CreateSandboxFromSnapshotParams
-
-    config = DaytonaConfig(
-        api_key=settings.daytona_api_key,
-        api_url=settings.daytona_api_url
-    )
-    daytona = Daytona(config)
+    return _strip_fences("".join(chunks))
 
-    params = CreateSandboxFromSnapshotParams(snapshot="manim-voiceover-v4")
-    sandbox = daytona.create(params)
+async def generate_manim_code(question: str, explanation: str) -> str:
+    content = _manim_content(question, explanation)
+    code = await _request_manim_code(content)
+    error = _validate_manim_code(code)
+    if error is None:
+        return code
 
-    code_safe = manim_code.encode('ascii', errors='ignore').decode('ascii')
-    code_b64 = base64.b64encode(code_safe.encode()).decode()
-    write_result = sandbox.process.exec(f"echo '{code_b64}' | base64 -d > scene.py")
+    # One corrective retry with the validation error fed back; far cheaper
+    # than discovering the problem inside the sandbox.
+    retry_content = content + [{
+        "type": "text",
+        "text": (
+            f"Your previous script failed validation before rendering: {error}\n\n"
+            f"Previous script:\n{code}\n\n"
+            "Return the full corrected script, following all the original requirements."
+        )
+    }]
+    code = await _request_manim_code(retry_content)
+    error = _validate_manim_code(code)
+    if error is not None:
+        raise Exception(f"Generated Manim code failed validation: {error}")
+    return code
 
-    verify_result = sandbox.process.exec("wc -l scene.py && head -5 scene.py")
+# Manim quality tiers: previews render at 480p15 in seconds, while "high"
+# spends most of its time in ffmpeg encoding 1080p60. Default stays at the
+# preview tier the product has always used.
+MANIM_QUALITY_FLAGS = {
+    "preview": "-ql",
+    "medium": "-qm",
+    "high": "-qh"
+}
 
-    render_result = sandbox.process.exec("python3 -m manim -ql scene.py ExplanationScene 2>&1")
+def _question_cache_key(question: str, quality: str = "preview") -> str:
+    return hashlib.sha256(f"{question.strip().lower()}|{quality}".encode()).hexdigest()
 
-    video_path_result = sandbox.process.exec("find media -name 'ExplanationScene.mp4' -type f 2>/dev/null")
-    video_path = video_path_result.result.strip()
+def create_sandbox():
+    return _DAYTONA.create(_SANDBOX_PARAMS)
 
-    if not video_path:
-        raise Exception(f"Video not found. Code verify: {verify_result.result[:200]}. Render: {render_result.result[:1000]}")
+# Sandbox creation is ~400ms at best and over a second under load, and it
+# sits on the critical path of every video. A background thread keeps a
+# small pool of pre-booted sandboxes; checkout becomes a queue get, and each
+# sandbox is reset and reused a bounded number of times before recycling.
+SANDBOX_POOL_SIZE = 2
+SANDBOX_MAX_USES = 20
+
+_sandbox_pool: queue.Queue = queue.Queue(maxsize=SANDBOX_POOL_SIZE)
+_sandbox_uses: dict[str, int] = {}
+_pool_cv = threading.Condition()
+_pool_filler_started = False
+# Sandboxes alive in the pool system: queued plus checked out. The filler
+# only tops up when this drops below SANDBOX_POOL_SIZE, so a released
+# sandbox finds a free queue slot and is actually reused instead of racing
+# an eager refill and getting deleted.
+_warm_count = 0
 
-    video_content_result = sandbox.process.exec(f"cat {video_path} | base64 | tr -d '\\n'")
-    video_base64 = video_content_result.result.strip()
-    video_base64_clean = ''.join(c for c in video_base64 if c.isalnum() or c in '+/=')
+def _fill_sandbox_pool():
+    global _warm_count
+    backoff = 1.0
+    while True:
+        with _pool_cv:
+            while _warm_count >= SANDBOX_POOL_SIZE:
+                _pool_cv.wait()
+            _warm_count += 1
+        try:
+            sandbox = create_sandbox()
+        except Exception as e:
+            with _pool_cv:
+                _warm_count -= 1
+            # Back off exponentially so a persistent failure (bad key,
+            # quota, outage) doesn't turn this loop into a busy spin
+            # hammering the Daytona API.
+            print(f"WARNING: sandbox pool refill failed: {e}", file=sys.stderr)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60.0)
+            continue
+        _sandbox_uses[sandbox.id] = 0
+        _sandbox_pool.put(sandbox)
+        backoff = 1.0
 
-    video_bytes = base64.b64decode(video_base64_clean)
+def _ensure_pool_filler():
+    global _pool_filler_started
+    with _pool_cv:
+        if not _pool_filler_started:
+            threading.Thread(target=_fill_sandbox_pool, daemon=True).start()
+            _pool_filler_started = True
 
+def _discard_sandbox(sandbox):
+    """Delete a sandbox and free its warm slot so the filler can top up."""
+    global _warm_count
+    _sandbox_uses.pop(sandbox.id, None)
+    with _pool_cv:
+        _warm_count -= 1
+        _pool_cv.notify()
     sandbox.delete()
 
-    return video_bytes, render_result.result
+def acquire_sandbox():
+    global _warm_count
+    _ensure_pool_filler()
+    try:
+        return _sandbox_pool.get_nowait()
+    except queue.Empty:
+        # Pool cold or drained under load; pay the boot cost this once. The
+        # sandbox joins the warm population since release returns it to the
+        # pool like any other.
+        sandbox = create_sandbox()
+        with _pool_cv:
+            _warm_count += 1
+        _sandbox_uses[sandbox.id] = 0
+        return sandbox
+
+def release_sandbox(sandbox):
+    uses = _sandbox_uses.get(sandbox.id, 0) + 1
+    _sandbox_uses[sandbox.id] = uses
+    if uses >= SANDBOX_MAX_USES:
+        _discard_sandbox(sandbox)
+        return
+    try:
+        sandbox.process.exec("rm -rf media scene.py")
+        _sandbox_pool.put_nowait(sandbox)
+    except Exception:
+        # Reset failed or the pool is already full; don't reuse it.
+        _discard_sandbox(sandbox)
+
+def execute_manim_code(manim_code: str, sandbox=None, quality: str = "preview") -> tuple[bytes, str]:
+    # If the caller supplied a sandbox it also owns releasing it on success,
+    # which lets it overlap the release with other work (e.g. the upload).
+    quality_flag = MANIM_QUALITY_FLAGS.get(quality, MANIM_QUALITY_FLAGS["preview"])
+    owns_sandbox = sandbox is None
+    if owns_sandbox:
+        sandbox = acquire_sandbox()
+
+    # The prompt requires ASCII-only Manim code; strip anything else before
+    # writing the file. Uploading raw bytes avoids the previous
+    # echo | base64 -d shell round-trip and its quoting pitfalls.
+    sandbox.fs.upload_file(manim_code.encode('ascii', errors='ignore'), "scene.py")
+
+    # Render and locate the output in one exec; every round trip to Daytona
+    # costs hundreds of ms.
+    result = sandbox.process.exec(
+        f"python3 -m manim {quality_flag} scene.py ExplanationScene 2>&1; "
+        "echo ---RENDER-END---; "
+        "find media -name 'ExplanationScene.mp4' -type f 2>/dev/null"
+    )
+    render_log, _, video_path = result.result.partition("---RENDER-END---")
+    video_path = video_path.strip()
 
-def upload_to_supabase(video_bytes: bytes, video_id: str) -> str:
+    if not video_path:
+        _discard_sandbox(sandbox)
+        raise Exception(f"Video not found. Render: {render_log[:1000]}")
+
+    # Pull the MP4 as raw bytes; no base64 inflation, no Python-level
+    # character filtering over a multi-MB string.
+    video_bytes = sandbox.fs.download_file(video_path)
+
+    if owns_sandbox:
+        release_sandbox(sandbox)
+
+    return video_bytes, render_log
+
+# Public URLs for a public bucket are a fixed prefix plus the object path;
+# building them here avoids a per-upload SDK call.
+_PUBLIC_URL_BASE = f"{settings.supabase_url}/storage/v1/object/public/videos/"
+
+async def upload_to_supabase(video_bytes: bytes, video_id: str) -> str:
+    supabase = await get_async_supabase()
     file_path = f"{video_id}.mp4"
 
-    supabase.storage.from_('videos').upload(
+    # Pass raw bytes: storage3 only accepts bytes/BufferedReader/FileIO and
+    # treats anything else as a filesystem path, so there is no streaming
+    # body to hand it. Awaiting the call keeps the multi-MB transfer off
+    # the threadpool.
+    await supabase.storage.from_('videos').upload(
         file_path,
         video_bytes,
         {'content-type': 'video/mp4', 'x-upsert': 'true'}
     )
 
-    public_url = supabase.storage.from_('videos').get_public_url(file_path)
+    return _PUBLIC_URL_BASE + file_path
 
-    return public_url
+CLEANUP_BATCH_SIZE = 1000
+
+async def cleanup_old_videos() -> dict:
+    supabase = await get_async_supabase()
+
+    # Storage timestamps are ISO-8601 UTC, which sorts lexically, so a plain
+    # string comparison replaces the per-row replace + fromisoformat parse.
+    cutoff_iso = (datetime.now(timezone.utc) - timedelta(days=1)).strftime('%Y-%m-%dT%H:%M:%S')
+    videos = await supabase.storage.from_('videos').list()
+    old_videos = [video['name'] for video in videos if video['created_at'] < cutoff_iso]
 
-def cleanup_old_videos() -> dict:
-    cutoff_time = datetime.now(timezone.utc) - timedelta(days=1)
-    videos = supabase.storage.from_('videos').list()
-    old_videos = [
-        video['name'] for video in videos
-        if datetime.fromisoformat(video['created_at'].replace('Z', '+00:00')) < cutoff_time
-    ]
     if old_videos:
-        supabase.storage.from_('videos').remove(old_videos)
+        # Delete in bounded batches, concurrently, instead of one giant request.
+        await asyncio.gather(*[
+            supabase.storage.from_('videos').remove(old_videos[i:i + CLEANUP_BATCH_SIZE])
+            for i in range(0, len(old_videos), CLEANUP_BATCH_SIZE)
+        ])
+
+    # Prune cache rows alongside the files so cached URLs never point at
+    # deleted objects.
+    await supabase.table("video_cache").delete().lt("created_at", cutoff_iso).execute()
+
     return {"deleted": len(old_videos), "files": old_videos}
 
-def generate_video(question: str) -> dict:
-    video_id = str(uuid.uuid4())
+async def generate_video(question: str, quality: str = "preview") -> dict:
+    # .hex gives the same 128 bits as the hyphenated form in a shorter
+    # storage key.
+    video_id = uuid.uuid4().hex
 
     try:
-        manim_code = get_or_generate_code(question)
-        video_bytes, render_log = execute_manim_code(manim_code)
-        video_url = upload_to_supabase(video_bytes, video_id)
+        # Questions repeat heavily in practice sessions; a cache hit skips
+        # both LLM calls and the whole sandbox render.
+        cache_key = _question_cache_key(question, quality)
+        cached = await asyncio.to_thread(
+            lambda: get_supabase().table("video_cache").select("video_url").eq("question_hash", cache_key).execute()
+        )
+        if cached.data:
+            return {
+                "video_id": video_id,
+                "status": "completed",
+                "video_url": cached.data[0]["video_url"],
+                "error": None
+            }
+
+        explanation = await generate_explanation(question)
+
+        # Sandbox boot takes seconds; kick it off as soon as the explanation
+        # is back so it overlaps with Sonnet decoding the Manim code.
+        sandbox_task = asyncio.create_task(asyncio.to_thread(acquire_sandbox))
+        try:
+            manim_code = await generate_manim_code(question, explanation)
+        except Exception:
+            # Don't abandon the warmup task: it holds (or will hold) a booted
+            # sandbox that would otherwise leak. It is unused, so release it
+            # back to the pool.
+            sandbox = await sandbox_task
+            await asyncio.to_thread(release_sandbox, sandbox)
+            raise
+        sandbox = await sandbox_task
+
+        video_bytes, render_log = await asyncio.to_thread(execute_manim_code, manim_code, sandbox, quality)
+
+        # The upload and the sandbox reset/release are independent; running
+        # them together takes the teardown round-trip off the critical path.
+        video_url, _ = await asyncio.gather(
+            upload_to_supabase(video_bytes, video_id),
+            asyncio.to_thread(release_sandbox, sandbox)
+        )
+
+        await asyncio.to_thread(
+            lambda: get_supabase().table("video_cache").upsert({
+                "question_hash": cache_key,
+                "manim_code": manim_code,
+                "video_url": video_url,
+                "created_at": datetime.now(timezone.utc).isoformat()
+            }).execute()
+        )
 
         return {
             "video_id": video_id,
@@ -148,3 +425,114 @@ def generate_video(question: str) -> dict:
             "video_url": None,
             "error": str(e)
         }
+
+BATCH_POLL_INTERVAL = 10.0
+
+async def _run_message_batch(requests: list[dict]) -> dict:
+    """Submit one Message Batch and poll until it ends; returns custom_id -> message."""
+    batch = await client.messages.batches.create(requests=requests)
+    while batch.processing_status != "ended":
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+        batch = await client.messages.batches.retrieve(batch.id)
+
+    results = {}
+    async for entry in await client.messages.batches.results(batch.id):
+        if entry.result.type == "succeeded":
+            results[entry.custom_id] = entry.result.message
+    return results
+
+async def generate_videos_batch(questions: list[str]) -> list[dict]:
+    """
+    Pre-generate videos for a set of questions via the Anthropic Batches API.
+
+    Batched requests cost roughly half the interactive token price and lift
+    the aggregate throughput ceiling, at the price of minutes of turnaround —
+    use this for offline jobs (cron, pre-rendering a homework set), not for
+    student-facing requests, which stay on generate_video's streaming path.
+    """
+    explain_results = await _run_message_batch([
+        {
+            "custom_id": f"explain-{i}",
+            "params": {
+                "model": "claude-haiku-4-5-20251001",
+                "max_tokens": 1024,
+                "messages": [{"role": "user", "content": _explain_content(question)}]
+            }
+        }
+        for i, question in enumerate(questions)
+    ])
+
+    explanations = {}
+    for i in range(len(questions)):
+        message = explain_results.get(f"explain-{i}")
+        if message is not None:
+            explanations[i] = _parse_explanation(message.content[0].text)
+
+    code_results = await _run_message_batch([
+        {
+            "custom_id": f"manim-{i}",
+            "params": {
+                "model": "claude-sonnet-4-5-20250929",
+                "max_tokens": 2048,
+                "messages": [{"role": "user", "content": _manim_content(questions[i], explanation)}]
+            }
+        }
+        for i, explanation in explanations.items()
+    ])
+
+    results = []
+    for i, question in enumerate(questions):
+        video_id = uuid.uuid4().hex
+        message = code_results.get(f"manim-{i}")
+        if message is None:
+            results.append({
+                "question": question,
+                "video_id": video_id,
+                "status": "failed",
+                "video_url": None,
+                "error": "Batch LLM request did not succeed"
+            })
+            continue
+
+        manim_code = _strip_fences(message.content[0].text)
+        validation_error = _validate_manim_code(manim_code)
+        if validation_error is not None:
+            # Batch turnaround is minutes, so no corrective retry here; just
+            # avoid burning a sandbox on code that cannot render.
+            results.append({
+                "question": question,
+                "video_id": video_id,
+                "status": "failed",
+                "video_url": None,
+                "error": f"Generated Manim code failed validation: {validation_error}"
+            })
+            continue
+        try:
+            video_bytes, render_log = await asyncio.to_thread(execute_manim_code, manim_code)
+            video_url = await upload_to_supabase(video_bytes, video_id)
+            cache_key = _question_cache_key(question)
+            await asyncio.to_thread(
+                lambda: get_supabase().table("video_cache").upsert({
+                    "question_hash": cache_key,
+                    "manim_code": manim_code,
+                    "video_url": video_url,
+                    "created_at": datetime.now(timezone.utc).isoformat()
+                }).execute()
+            )
+            results.append({
+                "question": question,
+                "video_id": video_id,
+                "status": "completed",
+                "video_url": video_url,
+                "error": None
+            })
+        except Exception as e:
+            results.append({
+                "question": question,
+                "video_id": video_id,
+                "status": "failed",
+                "video_url": None,
+                "error": str(e)
+            })
+
+    return results
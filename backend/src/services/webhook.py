@@ -7,8 +7,10 @@ import json
 
 try:
     from config import settings
+    from models.schemas import ClerkUserData
 except ModuleNotFoundError:
     from src.config import settings
+    from src.models.schemas import ClerkUserData
 
 
 async def verify_webhook_signature(request: Request, webhook_secret: str) -> dict:
@@ -62,30 +64,25 @@ async def verify_webhook_signature(request: Request, webhook_secret: str) -> dic
         )
 
 
-def extract_primary_email(user_data: dict) -> str | None:
+def extract_primary_email(user_data: ClerkUserData) -> str | None:
     """
-    Extract the primary email address from Clerk user data.
+    Extract the primary email address from parsed Clerk user data.
 
     Args:
-        user_data: Clerk user data dictionary
+        user_data: Validated Clerk user data model
 
     Returns:
         Primary email address or None if not found
     """
-    email_addresses = user_data.get("email_addresses", [])
-    primary_email_id = user_data.get("primary_email_address_id")
-
-    if not email_addresses:
-        return None
-
-    # Find the primary email
-    if primary_email_id:
-        for email_obj in email_addresses:
-            if email_obj.get("id") == primary_email_id:
-                return email_obj.get("email_address")
-
-    # Fallback to first email if primary not found
-    if email_addresses:
-        return email_addresses[0].get("email_address")
-
-    return None
+    primary_email_id = user_data.primary_email_address_id
+
+    # Single pass: return the primary as soon as it's seen, remembering the
+    # first address as the fallback for when there is no primary match.
+    first_email = None
+    for email_obj in user_data.email_addresses:
+        if primary_email_id and email_obj.id == primary_email_id:
+            return email_obj.email_address
+        if first_email is None:
+            first_email = email_obj.email_address
+
+    return first_email